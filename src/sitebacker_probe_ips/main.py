@@ -1,7 +1,11 @@
 import requests
+from requests.adapters import HTTPAdapter
+import csv
+import hashlib
 import json
 import os
 import re
+from pathlib import Path
 import fitz  # PyMuPDF
 import argparse
 import sys
@@ -10,56 +14,192 @@ import yaml
 
 PDF_URL = "https://ultra-portalstatic.ultradns.com/static/console/docs/REST-API_User_Guide.pdf"
 
+# Regular expressions for IPv4 and IPv6 addresses, compiled once
+# More comprehensive IPv4 pattern
+_IPV4_RE = re.compile(r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b')
+
+# Simpler IPv6 pattern that matches the specific format in this PDF
+_IPV6_RE = re.compile(r'2610:a1:[0-9a-fA-F]{4}:128::[0-9a-fA-F]{1,3}')
+
+# Strings that disqualify a line from being a region name, folded into a
+# single case-insensitive alternation so each line is scanned only once
+_EXCLUDE_FROM_REGIONS = [
+    "ip probes by region",
+    "available",
+    "2019",
+    "ipv4",
+    "ipv6",
+    "region",
+    "table",
+    "page",
+    "ultradns",
+    "confidential"
+]
+_EXCLUDE_RE = re.compile('|'.join(map(re.escape, _EXCLUDE_FROM_REGIONS)), re.IGNORECASE)
+
+# Shared session so retries reuse the same keep-alive connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=3))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=3))
+
+# Downloaded PDFs are cached on disk, keyed by URL, so reruns can revalidate
+# with a conditional request instead of re-transferring the whole body
+_CACHE_DIR = Path.home() / ".cache" / "sitebacker_probe_ips"
+
+def _cache_paths(url):
+    """Return the cached body and metadata sidecar paths for a URL."""
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return _CACHE_DIR / (key + ".pdf"), _CACHE_DIR / (key + ".json")
+
 def download_pdf_from_url(url):
-    """Downloads the PDF from the specified URL and returns it as a bytes object."""
+    """
+    Downloads the PDF from the specified URL and returns it as a bytes object.
+    Sends a conditional request when a cached copy exists and reuses the cached
+    body on a 304 Not Modified response.
+    """
+    body_path, meta_path = _cache_paths(url)
+
+    headers = {}
+    if body_path.exists() and meta_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        except (OSError, ValueError):
+            headers = {}
+
     try:
         print(f"Downloading PDF from {url}...")
-        response = requests.get(url)
-        response.raise_for_status()
+        with _SESSION.get(url, stream=True, timeout=30, headers=headers) as response:
+            if response.status_code == 304:
+                print("PDF unchanged on server; using cached copy")
+                return body_path.read_bytes()
+            response.raise_for_status()
+            # Stream the body in chunks instead of buffering it all at once
+            buffer = bytearray()
+            for chunk in response.iter_content(chunk_size=65536):
+                buffer.extend(chunk)
+            content = bytes(buffer)
+
+            # Update the cache; failure to write it is not fatal
+            try:
+                _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                body_path.write_bytes(content)
+                meta_path.write_text(json.dumps({
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                }))
+            except OSError as e:
+                print(f"Warning: could not update PDF cache: {e}")
+
         print("Download complete")
-        return response.content
+        return content
     except requests.exceptions.RequestException as e:
         print(f"Error downloading PDF: {e}")
+        if body_path.exists():
+            print("Falling back to cached copy of the PDF")
+            return body_path.read_bytes()
         return None
 
-def find_table_pages(pdf_content, search_term="IP Probes by Region", start_page=1, end_page=None):
+# Cache of extracted page text, keyed by 0-indexed page number. Text extraction
+# is the dominant cost of this script and the same pages are read on every pass.
+_page_text_cache = {}
+
+# Compiled case-insensitive patterns for search terms, so a scan doesn't
+# lowercase a full copy of every page's text just for a substring test
+_search_pattern_cache = {}
+
+def _get_search_pattern(search_term):
+    """Return a compiled case-insensitive pattern for a literal search term."""
+    pattern = _search_pattern_cache.get(search_term)
+    if pattern is None:
+        pattern = re.compile(re.escape(search_term), re.IGNORECASE)
+        _search_pattern_cache[search_term] = pattern
+    return pattern
+
+# Only plain text is ever needed, so skip ligature preservation and other
+# non-text work in MuPDF's extractor. Spaces are kept as-is because the
+# table's region names rely on them.
+_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+def get_page_text(doc, page_num):
+    """Return the text of a page (0-indexed), extracting it only once."""
+    text = _page_text_cache.get(page_num)
+    if text is None:
+        text = doc[page_num].get_text("text", flags=_TEXT_FLAGS)
+        _page_text_cache[page_num] = text
+    return text
+
+def find_table_pages_multi(doc, search_terms, start_page=1, end_page=None, max_hits=None):
     """
-    Search through the PDF to find pages that contain the specified search term.
-    Returns a list of page numbers (1-indexed) that contain the search term.
+    Scan the PDF once for several search terms and return a dict mapping each
+    term to the list of page numbers (1-indexed) that contain it.
+
+    Terms should be ordered from most to least specific. The table spans a
+    contiguous run of pages, so the scan stops early once that run ends, or
+    once max_hits of its pages have been found. Pages that match a term but
+    carry no probe addresses (table-of-contents entries, cross-references)
+    are collected without ending the scan.
     """
     try:
-        # Open PDF from memory
-        doc = fitz.open(stream=pdf_content, filetype="pdf")
-        
         if end_page is None:
             end_page = len(doc)
         else:
             end_page = min(end_page, len(doc))
-        
-        found_pages = []
-        
+
+        patterns = [(term, _get_search_pattern(term)) for term in search_terms]
+        found_pages = {term: [] for term in search_terms}
+        primary = search_terms[0]
+        table_hits = 0
+
         for page_num in range(start_page - 1, end_page):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            if search_term.lower() in text.lower():
-                found_pages.append(page_num + 1)  # Convert to 1-indexed
-                print(f"Found '{search_term}' on page {page_num + 1}")
-        
-        doc.close()
+            text = get_page_text(doc, page_num)
+
+            first_match = None
+            for term, pattern in patterns:
+                if pattern.search(text):
+                    found_pages[term].append(page_num + 1)  # Convert to 1-indexed
+                    if first_match is None:
+                        first_match = term
+
+            if first_match is not None:
+                # Report only the most specific term to keep output readable
+                print(f"Found '{first_match}' on page {page_num + 1}")
+
+            # Only pages that also contain probe addresses belong to the table
+            # itself; a mere mention of the term elsewhere must not end the scan
+            if first_match == primary and '2610:a1:' in text:
+                table_hits += 1
+                if max_hits is not None and table_hits >= max_hits:
+                    break
+            elif table_hits:
+                # The table's matching run has ended
+                break
+
         return found_pages
     except Exception as e:
         print(f"Error searching PDF: {e}")
-        return []
+        return {term: [] for term in search_terms}
 
-def print_pdf_content(pdf_content, pages, verbose=False):
+def find_table_pages(doc, search_term="IP Probes by Region", start_page=1, end_page=None, max_hits=None):
+    """
+    Search through the PDF to find pages that contain the specified search term.
+    Returns a list of page numbers (1-indexed) that contain the search term.
+    """
+    return find_table_pages_multi(doc, [search_term], start_page, end_page, max_hits)[search_term]
+
+def print_pdf_content(page_texts, pages, verbose=False):
     """
     Debug function to print the raw text content of the specified pages
-    to understand the structure of the PDF.
+    to understand the structure of the PDF. Reads from the page-text cache
+    populated during the scan, so no text is extracted twice.
     """
     if not verbose:
         return
-        
+
     try:
         # Parse page range if it's a string
         if isinstance(pages, str):
@@ -70,24 +210,17 @@ def print_pdf_content(pdf_content, pages, verbose=False):
         else:
             # If pages is a list, convert to 0-indexed
             pages_to_print = [p - 1 for p in pages]
-        
-        # Open PDF from memory
-        doc = fitz.open(stream=pdf_content, filetype="pdf")
-        
+
         # Process each page in the range
         for page_num in pages_to_print:
-            if page_num >= len(doc) or page_num < 0:
-                print(f"Warning: Page {page_num + 1} does not exist in the PDF")
+            text = page_texts.get(page_num)
+            if text is None:
+                print(f"Warning: Page {page_num + 1} was not extracted from the PDF")
                 continue
-            
+
             print(f"\n--- PAGE {page_num + 1} CONTENT ---")
-            page = doc[page_num]
-            text = page.get_text()
             print(text)
             print(f"--- END OF PAGE {page_num + 1} CONTENT ---\n")
-        
-        # Close the document
-        doc.close()
     except Exception as e:
         print(f"Error printing PDF content: {e}")
 
@@ -100,7 +233,7 @@ def normalize_region_name(region_name):
     normalized = region_name.replace('\u2013', '-').replace('\u2014', '-')
     return normalized
 
-def extract_ip_probes(pdf_content, pages):
+def extract_ip_probes(doc, pages):
     """
     Extracts the 'IP Probes by Region Available' table from the specified 
     PDF pages and returns a list of dictionaries with Region, IPv4, and IPv6.
@@ -115,35 +248,14 @@ def extract_ip_probes(pdf_content, pages):
         else:
             # If pages is a list, convert to 0-indexed
             pages_to_process = [p - 1 for p in pages]
-        
-        # Open PDF from memory
-        doc = fitz.open(stream=pdf_content, filetype="pdf")
-        
-        # Regular expressions for IPv4 and IPv6 addresses
-        # More comprehensive IPv4 pattern
-        ipv4_pattern = r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b'
-        
-        # Simpler IPv6 pattern that matches the specific format in this PDF
-        simple_ipv6_pattern = r'2610:a1:[0-9a-fA-F]{4}:128::[0-9a-fA-F]{1,3}'
-        
-        # List of strings to exclude from region names
-        exclude_from_regions = [
-            "ip probes by region",
-            "available",
-            "2019",
-            "ipv4",
-            "ipv6",
-            "region",
-            "table",
-            "page",
-            "ultradns",
-            "confidential"
-        ]
-        
-        # List to store extracted data
-        extracted_data = []
+
+        # Extracted data keyed by normalized region name; IPs are kept as
+        # insertion-ordered dicts so dedup stays O(1) per hit while the
+        # addresses keep the order they appear in the table
+        extracted = {}
         current_region = None
         in_table_section = False
+        first_table_page = None
         
         # Process each page in the range
         for page_num in pages_to_process:
@@ -151,9 +263,8 @@ def extract_ip_probes(pdf_content, pages):
                 print(f"Warning: Page {page_num + 1} does not exist in the PDF")
                 continue
             
-            page = doc[page_num]
-            text = page.get_text()
-            
+            text = get_page_text(doc, page_num)
+
             # Check if we're in the table section
             if "ip probes by region" in text.lower():
                 in_table_section = True
@@ -161,85 +272,103 @@ def extract_ip_probes(pdf_content, pages):
             
             if not in_table_section:
                 continue
-            
-            # Split text into lines
-            lines = text.split('\n')
+
+            if first_table_page is None:
+                # Anchor on a page that actually carries probe addresses; a
+                # TOC entry or cross-reference mentions the table title too
+                if '2610:a1:' in text:
+                    first_table_page = page_num
+            elif '2610:a1:' not in text:
+                # Past the table: a page without probe addresses means the
+                # table has ended, so skip the remaining pages entirely
+                break
+
+            # Walk the page's text blocks in reading order (top-to-bottom,
+            # left-to-right). MuPDF's layout engine keeps the table's columns
+            # spatially grouped, so region names and their IP addresses arrive
+            # as coherent blocks instead of interleaved raw-text lines.
+            blocks = doc[page_num].get_text("blocks", flags=_TEXT_FLAGS)
+            blocks.sort(key=lambda b: (b[1], b[0]))
+
+            lines = []
+            for block in blocks:
+                lines.extend(block[4].splitlines())
             
             # Process each line
-            for line in lines:
-                line = line.strip()
+            for raw_line in lines:
+                line = raw_line.strip()
                 if not line:
                     continue
                 
-                # Skip lines that are clearly not region names
-                line_lower = line.lower()
-                if any(exclude in line_lower for exclude in exclude_from_regions):
+                # Skip lines that are clearly not region names; the result is
+                # reused below so the exclude scan runs once per line
+                is_excluded = _EXCLUDE_RE.search(line) is not None
+                if is_excluded:
                     continue
                 
-                # Check if this line contains IP addresses
-                ipv4_addresses = re.findall(ipv4_pattern, line)
-                ipv6_addresses = re.findall(simple_ipv6_pattern, line)
+                # Check if this line contains IP addresses. Cheap substring
+                # tests reject most lines before the regexes have to run.
+                ipv4_addresses = _IPV4_RE.findall(line) if '.' in line else []
+                ipv6_addresses = _IPV6_RE.findall(line) if '2610:a1:' in line else []
                 
                 if ipv4_addresses or ipv6_addresses:
                     # This line contains IP addresses, so it's part of a region's data
                     if current_region:
                         # Normalize the region name
                         normalized_region = normalize_region_name(current_region)
-                        
-                        # Check if we already have an entry for this region
-                        region_entry = next((item for item in extracted_data if item["region"] == normalized_region), None)
-                        
-                        if region_entry:
-                            # Add to existing entry
-                            region_entry["ipv4"].extend([ip for ip in ipv4_addresses if ip not in region_entry["ipv4"]])
-                            region_entry["ipv6"].extend([ip for ip in ipv6_addresses if ip not in region_entry["ipv6"]])
-                        else:
-                            # Create new entry
-                            extracted_data.append({
-                                "region": normalized_region,
-                                "ipv4": ipv4_addresses,
-                                "ipv6": ipv6_addresses
-                            })
+
+                        entry = extracted.setdefault(normalized_region, {"ipv4": {}, "ipv6": {}})
+                        entry["ipv4"].update(dict.fromkeys(ipv4_addresses))
+                        entry["ipv6"].update(dict.fromkeys(ipv6_addresses))
                 else:
                     # This line doesn't contain IP addresses, so it might be a region name
                     # Check if it's a reasonable length for a region name and doesn't start with a number
-                    if len(line) > 1 and not line[0].isdigit() and not any(exclude in line_lower for exclude in exclude_from_regions):
-                        current_region = line.strip()
-        
-        # Close the document
-        doc.close()
-        
-        return extracted_data
+                    if len(line) > 1 and not line[0].isdigit() and not is_excluded:
+                        current_region = line  # already stripped
+
+        # Convert to a list of dicts, keeping the table's encounter order
+        return [
+            {"region": region, "ipv4": list(entry["ipv4"]), "ipv6": list(entry["ipv6"])}
+            for region, entry in extracted.items()
+        ]
     except Exception as e:
         print(f"Error extracting IP probes: {e}")
         return []
 
+# Use orjson's C-level encoder for JSON output when it's installed,
+# falling back to the stdlib encoder otherwise
+try:
+    import orjson
+
+    def _dump_json(data, f):
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+except ImportError:
+    def _dump_json(data, f):
+        json.dump(data, f, indent=2)
+
+def write_csv(f, data):
+    """Write the extracted data as CSV rows to an open file object."""
+    writer = csv.writer(f)
+    writer.writerow(("Region", "Type", "IP Address"))
+    for region in data:
+        writer.writerows((region["region"], "IPv4", ip) for ip in region["ipv4"])
+        writer.writerows((region["region"], "IPv6", ip) for ip in region["ipv6"])
+
 def save_to_file(data, output_file, format="json"):
     """Save the extracted data to a file in the specified format."""
     try:
-        with open(output_file, 'w') as f:
-            if format.lower() == "json":
-                json.dump(data, f, indent=2)
-            elif format.lower() == "yaml":
-                yaml.dump(data, f, default_flow_style=False, sort_keys=False)
-            elif format.lower() == "csv":
-                # Write CSV header
-                f.write("Region,Type,IP Address\n")
-                
-                # Write data rows
-                for region in data:
-                    region_name = region["region"]
-                    
-                    # Write IPv4 addresses
-                    for ip in region["ipv4"]:
-                        f.write(f'"{region_name}",IPv4,{ip}\n')
-                    
-                    # Write IPv6 addresses
-                    for ip in region["ipv6"]:
-                        f.write(f'"{region_name}",IPv6,{ip}\n')
-            else:
-                raise ValueError(f"Unsupported format: {format}")
-                
+        if format.lower() == "csv":
+            with open(output_file, 'w', newline='', buffering=8192) as f:
+                write_csv(f, data)
+        else:
+            with open(output_file, 'w') as f:
+                if format.lower() == "json":
+                    _dump_json(data, f)
+                elif format.lower() == "yaml":
+                    yaml.dump(data, f, default_flow_style=False, sort_keys=False)
+                else:
+                    raise ValueError(f"Unsupported format: {format}")
+
         print(f"Data saved to {output_file}")
         return True
     except Exception as e:
@@ -253,24 +382,12 @@ def output_data(data, format="json", output_file=None):
     else:
         # Print to stdout
         if format.lower() == "json":
-            print(json.dumps(data, indent=2))
+            _dump_json(data, sys.stdout)
+            print()
         elif format.lower() == "yaml":
             print(yaml.dump(data, default_flow_style=False, sort_keys=False))
         elif format.lower() == "csv":
-            # Write CSV header
-            print("Region,Type,IP Address")
-            
-            # Write data rows
-            for region in data:
-                region_name = region["region"]
-                
-                # Write IPv4 addresses
-                for ip in region["ipv4"]:
-                    print(f'"{region_name}",IPv4,{ip}')
-                
-                # Write IPv6 addresses
-                for ip in region["ipv6"]:
-                    print(f'"{region_name}",IPv6,{ip}')
+            write_csv(sys.stdout, data)
         else:
             print(f"Unsupported format: {format}")
             return False
@@ -304,29 +421,30 @@ def main():
         print("Failed to download PDF. Exiting.")
         sys.exit(1)
     
-    # Find pages that might contain the table
-    table_pages = find_table_pages(pdf_content, search_term="IP Probes by Region", start_page=1, end_page=300)
-    
-    if not table_pages:
-        # Try alternative search terms
-        table_pages = find_table_pages(pdf_content, search_term="Probes by Region", start_page=1, end_page=300)
-    
-    if not table_pages:
-        # If still not found, try a broader search
-        table_pages = find_table_pages(pdf_content, search_term="Probe", start_page=1, end_page=300)
-        
+    # Open the PDF once and reuse the parsed document everywhere
+    doc = fitz.open(stream=pdf_content, filetype="pdf")
+
+    # Scan the pages once for all search terms, from most to least specific
+    search_terms = ["IP Probes by Region", "Probes by Region", "Probe"]
+    pages_by_term = find_table_pages_multi(doc, search_terms, start_page=1, end_page=300, max_hits=5)
+
+    # Use the most specific term that matched anything
+    table_pages = next((pages_by_term[term] for term in search_terms if pages_by_term[term]), [])
+
     # If we found potential pages, print their content
     if table_pages:
         print(f"Found potential table pages: {table_pages}")
-        print_pdf_content(pdf_content, table_pages, args.verbose)
-        
+        print_pdf_content(_page_text_cache, table_pages, args.verbose)
+
         # Extract the table data from the found pages
-        ip_probes_data = extract_ip_probes(pdf_content, table_pages)
+        ip_probes_data = extract_ip_probes(doc, table_pages)
     else:
         # If no pages found, try the original pages
         print("No table pages found. Trying original pages 202-203...")
-        print_pdf_content(pdf_content, "202-203", args.verbose)
-        ip_probes_data = extract_ip_probes(pdf_content, "202-203")
+        print_pdf_content(_page_text_cache, "202-203", args.verbose)
+        ip_probes_data = extract_ip_probes(doc, "202-203")
+
+    doc.close()
 
     # Output the data
     if ip_probes_data: